@@ -1,36 +1,118 @@
 # Connect to the SQLite database
+import os
+import re
 import sqlite3
+import threading
 import pandas as pd
 import logging
 
+try:
+    import connectorx as cx # Optional: Arrow-native reads that skip per-row Python objects on large results
+except ImportError:
+    cx = None
+
 class Olist:
-    db_path = ''
+    db_path = '/Users/peter.boucher/.cache/kagglehub/datasets/terencicp/e-commerce-dataset-by-olist-as-an-sqlite-database/versions/1/olist.sqlite'
     logger = logging.getLogger(__name__)
+    # Keyword heuristic that fails obviously destructive SQL early with a clear message. It is not the
+    # read-only guarantee (REPLACE INTO, ATTACH, PRAGMA writes get past it): connect_data enforces that.
+    # REPLACE is not listed because replace() is also a SQLite string function.
+    _BANNED_RE = re.compile(r'\b(DROP|DELETE|TRUNCATE|ALTER|INSERT|UPDATE|CREATE|MERGE)\b', re.IGNORECASE)
 
     def __init__(self):
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self._conn = None
+        self._conn_lock = threading.Lock() # The SQL worker threads share this instance
 
     def connect_data(self):
-        self.db_path = '/Users/peter.boucher/.cache/kagglehub/datasets/terencicp/e-commerce-dataset-by-olist-as-an-sqlite-database/versions/1/olist.sqlite'
-        db_connection = sqlite3.connect(self.db_path)
-        return db_connection
+        with self._conn_lock:
+            if self._conn is None:
+                if os.getenv("OLIST_INMEM") == "1":
+                    # Copy the dataset into RAM once so back-to-back queries never touch the disk
+                    source = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+                    self._conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+                    source.backup(self._conn)
+                    source.close()
+                else:
+                    self._conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False, isolation_level=None)
+                # The in-memory copy is writable by nature, so both connections also refuse writes at the SQL level
+                self._conn.execute("PRAGMA query_only=ON")
+                # Read-only analytics workload: keep temp b-trees in memory and allow a 64 MiB page cache
+                self._conn.execute("PRAGMA temp_store=MEMORY")
+                self._conn.execute("PRAGMA cache_size=-65536")
+            return self._conn
+
+    def _forget_connection(self, conn):
+        # Only the first thread to notice a closed connection drops it; the others then share its replacement
+        with self._conn_lock:
+            if self._conn is conn:
+                self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
     
+    def safety_check(self, query):
+        match = self._BANNED_RE.search(query)
+        if match:
+            verb = match.group(1).upper()
+            self.logger.error("Banned SQL verb found: %s", verb)
+            raise ValueError(f"Banned SQL verb {verb}: only read-only queries are allowed")
+
     def execute_sql_query(self, query, iteration=0):
+        # connectorx reads the file itself, so it is skipped when the data lives in an in-memory copy
+        if cx is not None and os.getenv("OLIST_INMEM") != "1":
+            self.validate_query(query, iteration)
+            try:
+                self.logger.info("Executing SQL query with connectorx:\n%s", query)
+                return cx.read_sql(f"sqlite://{self.db_path}", query, return_type="pandas")
+            except Exception as e:
+                # The sqlite3 path below re-raises a genuine SQL error in the form the fix loop expects
+                self.logger.warning("connectorx read failed, falling back to sqlite3: %s", e)
+        columns, rows = self.execute_sql_query_rows(query, iteration)
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def validate_query(self, query, iteration=0):
         if not isinstance(query, str):
-            self.logger.error("Query must be a string, found", query.__class__)
+            self.logger.error("Query must be a string, found %s", type(query).__name__)
             raise ValueError("Query must be a string")
         elif iteration > 3:
-            self.logger.error("Iteration limit exeeded: ", iteration)
+            self.logger.error("Iteration limit exeeded: %d", iteration)
             raise ValueError("Iteration limit exeeded")
+        self.safety_check(query)
+
+    def execute_sql_query_rows(self, query, iteration=0):
+        self.validate_query(query, iteration)
         
         try:
             conn = self.connect_data()
-            self.logger.info(f"Executing SQL query:\n{query}")
-            result = pd.read_sql_query(query, conn)
-            self.logger.info(f"Query executed successfully")
-            self.logger.info(f"Result: {result}")
-            return result
+            self.logger.info("Executing SQL query:\n%s", query)
+            try:
+                cursor = conn.execute(query)
+            except sqlite3.ProgrammingError as e:
+                # Multi-statement SQL and binding errors are ProgrammingErrors too: only a closed connection is retried
+                if 'closed database' not in str(e):
+                    raise
+                self._forget_connection(conn)
+                cursor = self.connect_data().execute(query)
+            columns = [column[0] for column in cursor.description or []]
+            rows = cursor.fetchall()
+            self.logger.info("Query executed successfully")
+            self.logger.info("Result: %d rows x %d cols", len(rows), len(columns))
+            return columns, rows
         except Exception as e:
             #TODO: catch sqlaclchemy.exc.ProgrammingError, sqlalchemy.exc.OperationalError
-            self.logger.error(f"An error occurred: {e}")
+            self.logger.error("An error occurred: %s", e)
             raise e
+
+def format_result_for_llm(columns, rows, max_rows=50):
+    """Render query rows as a compact markdown table, truncated to max_rows, to feed into the next LLM turn"""
+    def cell(value):
+        return str(value).replace("|", "\\|")
+
+    lines = ["| " + " | ".join(map(cell, columns)) + " |", "|" + " --- |" * len(columns)]
+    lines += ["| " + " | ".join(map(cell, row)) + " |" for row in rows[:max_rows]]
+    if len(rows) > max_rows:
+        lines.append(f"... {len(rows) - max_rows} more rows")
+    return "\n".join(lines)
@@ -1,9 +1,93 @@
+import asyncio
+from collections import deque
+import functools
+import hashlib
+import inspect
+import json
 import logging
+import threading
 import time
-from openai import AzureOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI, APIConnectionError, APITimeoutError, DefaultHttpxClient, RateLimitError, pydantic_function_tool
+from openai.types.chat import ChatCompletion, ParsedChatCompletion
 import os
+from pathlib import Path
 import dotenv
+import httpx
 from pydantic import BaseModel, Field
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+# Absorb transient Azure throttling/connection errors instead of failing the whole question.
+# This is the only retry layer: the clients are created with the SDK's own retries disabled (max_retries=0).
+retry_transient_errors = retry(
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError)),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+@functools.lru_cache(maxsize=None)
+def response_format_param(response_format):
+    """Strict JSON-schema response_format for a Pydantic model, as .parse() sends it (for the Batch API and cache keys)"""
+    function = pydantic_function_tool(response_format)["function"]
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": function["name"], "schema": function["parameters"], "strict": True}
+    }
+
+CACHE_DIR = Path.home() / ".cache" / "llm-lab-katas"
+
+def cache_key(model, messages, response_format):
+    if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+        response_format = response_format_param(response_format)
+    payload = json.dumps(
+        [model, messages, response_format],
+        sort_keys=True,
+        default=lambda value: value.model_dump(exclude_none=True) if isinstance(value, BaseModel) else str(value)
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def disk_cached(request):
+    """Replay completions from CACHE_DIR for identical (model, messages, schema) requests; enabled with LLM_CACHE=1"""
+    def load(path, response_format, parsed):
+        if not parsed:
+            return ChatCompletion.model_validate_json(path.read_text())
+        completion = ParsedChatCompletion[response_format].model_validate_json(path.read_text())
+        for choice in completion.choices:
+            if choice.message.content:
+                choice.message.parsed = response_format.model_validate_json(choice.message.content)
+        return completion
+
+    def store(path, response):
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Store the completion as the API returned it: dumping the generic parsed model warns, and load() rebuilds it
+        path.write_text(response.model_dump_json(exclude={'choices': {'__all__': {'message': {'parsed'}}}}))
+
+    if inspect.iscoroutinefunction(request):
+        @functools.wraps(request)
+        async def async_wrapper(self, messages, response_format, parsed):
+            if os.getenv("LLM_CACHE") != "1":
+                return await request(self, messages, response_format, parsed)
+            path = CACHE_DIR / f"{cache_key(self.MODEL, messages, response_format)}.json"
+            if path.exists():
+                self.logger.info("Replaying cached completion %s", path.name)
+                return load(path, response_format, parsed)
+            response = await request(self, messages, response_format, parsed)
+            store(path, response)
+            return response
+        return async_wrapper
+
+    @functools.wraps(request)
+    def wrapper(self, messages, response_format, parsed):
+        if os.getenv("LLM_CACHE") != "1":
+            return request(self, messages, response_format, parsed)
+        path = CACHE_DIR / f"{cache_key(self.MODEL, messages, response_format)}.json"
+        if path.exists():
+            self.logger.info("Replaying cached completion %s", path.name)
+            return load(path, response_format, parsed)
+        response = request(self, messages, response_format, parsed)
+        store(path, response)
+        return response
+    return wrapper
 
 class LLMClient:
     dotenv.load_dotenv("../.env")
@@ -11,6 +95,7 @@ class LLMClient:
     API_KEY = os.getenv("OPENAI_API_KEY")
     API_VER = os.getenv("AZURE_OPENAI_API_VERSION") # Support for structured outputs was first added in API version 2024-08-01-preview. It is available in the latest preview APIs as well as the latest GA API: 2024-10-21.
     MODEL = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+    EMBEDDING_MODEL = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") # Optional, e.g. text-embedding-3-small
     ## Supported models
     # gpt-4.5-preview version 2025-02-27
     # o3-mini version 2025-01-31
@@ -21,73 +106,242 @@ class LLMClient:
 
     logger = logging.getLogger(__name__)
 
-    chat_history = []
+    MAX_HISTORY_MESSAGES = 20 # Oldest messages are dropped first, bounding the prompt size of long sessions
+
+    TIMEOUT = 60.0 # Seconds; fail fast instead of hanging on a stalled request
 
     def __init__(self):
-        self.client = AzureOpenAI(
-            azure_endpoint=self.ENDPOINT,
-            api_key=self.API_KEY,
-            api_version=self.API_VER
-        )
+        # Shared across instances so keep-alive connections (and their TLS sessions) are reused
+        self.client = _AZURE_CLIENT
+        self._aclient = None
+        self._aclient_loop = None
+        self.chat_history = []
+        # Running totals updated per response, so reporting usage never rescans the history
+        self._usage_lock = threading.Lock()
+        self._usage_totals = {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'cached_tokens': 0}
+
+    @property
+    def aclient(self):
+        # An async connection pool is bound to the event loop that opened its connections, and each
+        # asyncio.run() starts a new loop: reusing the pool there fails with "Event loop is closed"
+        loop = asyncio.get_running_loop()
+        if self._aclient_loop is not loop:
+            self._aclient = AsyncAzureOpenAI(
+                azure_endpoint=self.ENDPOINT,
+                api_key=self.API_KEY,
+                api_version=self.API_VER,
+                timeout=self.TIMEOUT,
+                max_retries=0
+            )
+            self._aclient_loop = loop
+        return self._aclient
+
+    @property
+    def chat_history(self):
+        return self._chat_history
+
+    @chat_history.setter
+    def chat_history(self, chat_history):
+        self._chat_history = deque(maxlen=self.MAX_HISTORY_MESSAGES)
+        self._flat_history = deque()
+        for item in chat_history:
+            self._append_history(item)
 
     def add_chat_history(self, messages):
-        self.chat_history.append({'timestamp': time.time(), 'conversation': messages})
-    
+        self._append_history({'timestamp': time.time(), 'conversation': messages})
+
+    def _append_history(self, item):
+        self._chat_history.append(item)
+        if not isinstance(item['conversation'], list):
+            self._flat_history.append(item['conversation'])
+        else:
+            for message in item['conversation']:
+                if 'role' in message and message['role'] != 'system': # Add only the user and assistant messages
+                    self._flat_history.append(message)
+        # Drop the oldest messages, plus any reply left at the front without the question it answers
+        while len(self._flat_history) > self.MAX_HISTORY_MESSAGES or (
+                self._flat_history and self._role(self._flat_history[0]) == 'assistant'):
+            self._flat_history.popleft()
+
+    @staticmethod
+    def _role(message):
+        return message['role'] if isinstance(message, dict) else getattr(message, 'role', None)
+
     def recall_chat_history(self):
-        messages = []
-        for item in self.chat_history:
-            if not isinstance(item['conversation'], list):
-                messages.append(item['conversation'])
-            else:
-                for message in item['conversation']:
-                    if 'role' in message and message['role'] != 'system': # Add only the user and assistant messages
-                        messages.append(message)
-        return messages
+        return list(self._flat_history)
+
+    def reset_history(self):
+        self.chat_history = []
+
+    def usage_totals(self):
+        with self._usage_lock:
+            return dict(self._usage_totals)
 
     def chat_completion(self, messages, response_format, include_history=True, parsed=False):
-        if include_history and len(self.chat_history) > 0:
-            history = self.recall_chat_history()
-            messages = history + messages
-        self.logger.info(f"Sending query to LLM: {messages}")
+        prompt = self._with_history(messages, include_history)
+        self.logger.info("Sending query to LLM: %s", prompt)
+        try:
+            response = self._complete_with_retry(prompt, response_format, parsed)
+            self._record_response(messages, response, parsed, include_history)
+            return response
+        except Exception as e:
+            self.logger.error("An error occurred: %s", e)
+            raise e
+
+    async def achat_completion(self, messages, response_format, include_history=True, parsed=False):
+        prompt = self._with_history(messages, include_history)
+        self.logger.info("Sending query to LLM: %s", prompt)
         try:
-            if parsed:
-                response = self.client.beta.chat.completions.parse(
-                    model=self.MODEL,
-                    messages=messages,
-                    response_format=response_format
-                )
-            else:
-                response = self.client.chat.completions.create(
-                    model=self.MODEL,
-                    messages=messages,
-                    response_format=response_format
-                )
-            self.logger.info(f"Response: {response}")
-            self.logger.info(f"Used tokens: {response.usage}")
-            self.add_chat_history(messages)
-            self.add_chat_history(response.choices[0].message)
-            if parsed:
-                for step in response.choices[0].message.parsed.steps:
-                    self.logger.info(f"REASONING - Step: {step}")
+            response = await self._acomplete_with_retry(prompt, response_format, parsed)
+            self._record_response(messages, response, parsed, include_history)
             return response
         except Exception as e:
-            self.logger.error(f"An error occurred: {e}")
+            self.logger.error("An error occurred: %s", e)
             raise e
 
+    @disk_cached
+    @retry_transient_errors
+    def _complete_with_retry(self, messages, response_format, parsed):
+        if parsed:
+            return self.client.beta.chat.completions.parse(
+                model=self.MODEL,
+                messages=messages,
+                response_format=response_format
+            )
+        return self.client.chat.completions.create(
+            model=self.MODEL,
+            messages=messages,
+            response_format=response_format
+        )
+
+    @disk_cached
+    @retry_transient_errors
+    async def _acomplete_with_retry(self, messages, response_format, parsed):
+        if parsed:
+            return await self.aclient.beta.chat.completions.parse(
+                model=self.MODEL,
+                messages=messages,
+                response_format=response_format
+            )
+        return await self.aclient.chat.completions.create(
+            model=self.MODEL,
+            messages=messages,
+            response_format=response_format
+        )
+
+    def embed(self, text):
+        return self.client.embeddings.create(model=self.EMBEDDING_MODEL, input=text).data[0].embedding
+
+    def submit_batch(self, messages_list, response_format):
+        """Submit one chat completion per conversation to the Batch API and return the batch id"""
+        if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+            response_format = response_format_param(response_format)
+        requests = [
+            json.dumps({
+                "custom_id": f"req-{i}",
+                "method": "POST",
+                "url": "/chat/completions",
+                "body": {"model": self.MODEL, "messages": messages, "response_format": response_format}
+            })
+            for i, messages in enumerate(messages_list)
+        ]
+        batch_file = self.client.files.create(file=("batch.jsonl", "\n".join(requests).encode()), purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/chat/completions",
+            completion_window="24h"
+        )
+        self.logger.info("Submitted batch %s with %d requests", batch.id, len(requests))
+        return batch.id
+
+    def poll_batch(self, batch_id, interval=60):
+        """Wait for a batch to finish and return its completions in submission order (None for failed requests)"""
+        batch = self.client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            self.logger.info("Batch %s is %s: %s", batch_id, batch.status, batch.request_counts)
+            time.sleep(interval)
+            batch = self.client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            self.logger.error("Batch %s ended with status %s: %s", batch_id, batch.status, batch.errors)
+            raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+
+        completions = [None] * batch.request_counts.total
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line:
+                continue
+            result = json.loads(line)
+            index = int(result["custom_id"].removeprefix("req-"))
+            if result.get("error") or result["response"]["status_code"] != 200:
+                self.logger.error("Batch request %s failed: %s", result["custom_id"], result.get("error") or result["response"])
+                continue
+            completions[index] = ChatCompletion.model_validate(result["response"]["body"])
+        return completions
+
+    def _with_history(self, messages, include_history):
+        if include_history and len(self.chat_history) > 0:
+            # History goes right before the new turn, so the caller's leading messages (system context and
+            # few-shot examples) remain an identical prefix that the provider's prompt cache can reuse.
+            # Only the last message counts as new: multi-turn prompts should pass include_history=False.
+            history = self.recall_chat_history()
+            messages = messages[:-1] + history + messages[-1:]
+        return messages
+
+    def _record_response(self, messages, response, parsed, include_history):
+        # Only the new question and its reply are recorded: the leading context and few-shot
+        # examples are re-sent with every prompt, and the recalled history is already in chat_history.
+        # Calls made without history (fixes on worker threads, concurrent questions, evaluations)
+        # stay out of the conversation entirely, so only its own turns are ever written to it.
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Response: %s", response)
+        self.logger.info("Used tokens: %s", response.usage)
+        if response.usage is not None:
+            cached_tokens = self._add_usage(response.usage)
+            self.logger.info("Prompt tokens served from cache: %s", cached_tokens)
+        if include_history:
+            self.add_chat_history(messages[-1:])
+            self.add_chat_history({'role': 'assistant', 'content': response.choices[0].message.content})
+        if parsed:
+            for step in getattr(response.choices[0].message.parsed, 'steps', []):
+                self.logger.info("REASONING - Step: %s", step)
+
+    def _add_usage(self, usage):
+        # Fix-up completions run on the SQL worker threads, so the counters are shared
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', None) or 0 # Older API versions omit the details
+        with self._usage_lock:
+            self._usage_totals['requests'] += 1
+            self._usage_totals['prompt_tokens'] += usage.prompt_tokens
+            self._usage_totals['completion_tokens'] += usage.completion_tokens
+            self._usage_totals['total_tokens'] += usage.total_tokens
+            self._usage_totals['cached_tokens'] += cached_tokens
+        return cached_tokens
+
+_AZURE_CLIENT = AzureOpenAI(
+    azure_endpoint=LLMClient.ENDPOINT,
+    api_key=LLMClient.API_KEY,
+    api_version=LLMClient.API_VER,
+    timeout=LLMClient.TIMEOUT,
+    max_retries=0,
+    # DefaultHttpxClient keeps the SDK's own client defaults (timeouts, redirects) and only widens the pool
+    http_client=DefaultHttpxClient(limits=httpx.Limits(max_keepalive_connections=20, max_connections=40))
+)
+
 if __name__ == "__main__":
     class SQLGeneration(BaseModel):
         # role: str = Field(..., description="The role of the message")
         steps: list[str] = Field(..., description="Short chain-of-thought steps explaining the logic")
         sql_query: str = Field(..., description="The final SQL query to answer the user request")
 
+    class SQLGenerationBatch(BaseModel):
+        answers: list[SQLGeneration] = Field(..., description="One SQL generation per question, in the order the questions were asked")
+
     client = LLMClient()
     messages = [
-        {"role": "system", "content": "You are an expert in Olist's DB. Provide 1-3 short reasoning steps, then a final SQL."},
-        {"role": "user", "content": "Which seller has delivered the most orders to customers in Rio de Janeiro?"}
-    ]
-    response = client.chat_completion_parsed(messages, SQLGeneration)
-    messages = [
+        {"role": "system", "content": "You are an expert in Olist's DB. For each question, provide 1-3 short reasoning steps, then a final SQL."},
+        {"role": "user", "content": "Which seller has delivered the most orders to customers in Rio de Janeiro?"},
+        # Both turns are known up front, so send the follow-up in the same request instead of a second round-trip
         {"role": "user", "content": "How many orders did they deliver to customers in Rio de Janeiro?"}
     ]
-    response = client.chat_completion_parsed(messages, SQLGeneration)
-    pass
\ No newline at end of file
+    response = client.chat_completion(messages, SQLGenerationBatch, parsed=True)
+    for answer in response.choices[0].message.parsed.answers:
+        print(answer.sql_query)
@@ -1,87 +1,264 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import json
+import os
 from pathlib import Path
+import sys
 from pydantic import BaseModel, Field
 import logging
 
 from db_client import Olist
-from llm_client import LLMClient
-from sample_db_queries import examples
+from llm_client import CACHE_DIR, LLMClient, cache_key, response_format_param
+from response_cache import ResponseCache
+from sample_db_queries import flat_examples
 
 llm_client = LLMClient()
 
 logger = logging.getLogger(__name__)
-try:
-    logging.basicConfig(
-        level=logging.INFO, 
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        filename='logs/app.log',
-        filemode='w'
-    )
-except FileNotFoundError as e:
-    logger.error(f"Couldn't find a logfile: {e}")
+
+def setup_logging(log_dir=Path('logs'), filename='app.log'):
+    log_dir.mkdir(parents=True, exist_ok=True)
+    # force replaces the console-only config Olist() installs, however often this is called
     logging.basicConfig(
         level=logging.INFO, 
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        filename=log_dir / filename,
+        filemode='w',
+        force=True
     )
 
+# The connection itself is opened lazily on the first query and then shared by every question.
+data = Olist()
 
 class SQLGeneration(BaseModel):
     steps: list[str] = Field(..., description="Short chain-of-thought steps explaining the logic")
     sql_query: str = Field(..., description="The final SQL query to answer the user request")
 
-def setup():
-    global data
-    data = Olist()
+class SQLGenerationBatch(BaseModel):
+    answers: list[SQLGeneration] = Field(..., description="One SQL generation per question, in the order the questions were asked")
 
-def build_prompt(question):
-    context = get_context()
-    messages = [
-        {"role": "system", "content": context},
-        {"role": "system", "content": "You are an expert in Olist's DB. Provide 1-3 short reasoning steps, then a final SQL."}
-    ]
-    list(map(lambda example: list(map(lambda message: messages.append(message), example)), examples))
-    messages.append(
-        {"role": "user", "content": question}
+SQL_SCHEMA = response_format_param(SQLGeneration)
+
+MAX_QUERY_ATTEMPTS = 4 # Matches the iteration limit enforced by Olist.execute_sql_query
+SQL_WORKERS = 4 # Olist shares one connection opened with check_same_thread=False
+
+EXPERT_MESSAGE = {"role": "system", "content": "You are an expert in Olist's DB. Provide 1-3 short reasoning steps, then a final SQL."}
+
+@functools.lru_cache(maxsize=1)
+def get_prompt_prefix():
+    # Sending byte-identical leading messages for every question lets the provider reuse its prompt cache
+    return (
+        {"role": "system", "content": get_context()},
+        EXPERT_MESSAGE,
+        *flat_examples
     )
-    logger.info(f"Constructed prompt: {messages}")
+
+def build_prompt(question):
+    messages = [*get_prompt_prefix(), {"role": "user", "content": question}]
+    logger.info("Constructed prompt: %s", messages)
+    return messages
+
+def build_batch_prompt(questions):
+    numbered_questions = "\n".join(f"{number}. {question}" for number, question in enumerate(questions, start=1))
+    messages = [*get_prompt_prefix(), {"role": "user", "content": "Answer each of the following questions with its own SQL query, in the same order:\n" + numbered_questions}]
+    logger.info("Constructed batch prompt: %s", messages)
     return messages
 
 def completion(messages):
+    # Only sql_query is read from the answer, so skip the SDK's Pydantic validation and decode it in extract_sql
     response = llm_client.chat_completion(
         messages=messages,
+        response_format=SQL_SCHEMA,
+        include_history=True
+    )
+    return response
+
+async def completion_async(messages):
+    # Questions answered concurrently are independent: sharing history would make
+    # each prompt depend on the order in which the other completions finish.
+    response = await llm_client.achat_completion(
+        messages=messages,
+        response_format=SQL_SCHEMA,
+        include_history=False
+    )
+    return response
+
+def fix_prompt(error, last_query='', original_prompt=''):
+    context = get_context()
+    return [{"role": "system", "content": context},
+            {"role": "user", "content": original_prompt},
+            {"role": "assistant", "content": last_query},         
+            {"role": "user", "content": "When running the SQL I recieved the following error: \n"
+              + str(error) + "\nPlease change the SQL query to fix the error. Provide 1-3 short reasoning steps, then a final SQL."}]
+
+def generate_fix(error, last_query='', original_prompt=''):
+    # The fix prompt already carries the question and the failing query: recalled history would
+    # land between that query and the error message about it
+    response = llm_client.chat_completion(
+        messages=fix_prompt(error, last_query, original_prompt),
         response_format=SQLGeneration,
-        include_history=True,
+        include_history=False,
         parsed=True
     )
     return response
 
-def generate_fix(error, last_query='', original_prompt=''):
-    context = get_context()
-    messages = [{"role": "system", "content": context},
-                {"role": "user", "content": original_prompt},
-                {"role": "assistant", "content": last_query},         
-                {"role": "user", "content": "When running the SQL I recieved the following error: \n"
-                  + str(error) + "\nPlease change the SQL query to fix the error. Provide 1-3 short reasoning steps, then a final SQL."}]
-    return completion(messages)
+async def generate_fix_async(error, last_query='', original_prompt=''):
+    response = await llm_client.achat_completion(
+        messages=fix_prompt(error, last_query, original_prompt),
+        response_format=SQLGeneration,
+        include_history=False,
+        parsed=True
+    )
+    return response
 
+@functools.lru_cache(maxsize=1)
 def get_context():
-    context = Path('../1-entry-assignment/context_prompt.md').read_text()
+    context = Path('../1-entry-assignment/context_prompt.md').read_bytes().decode('utf-8')
     return context
 
-def answer_question(question):
-    # setup()
-    response = completion(build_prompt(question))
-    parsed_json = response.choices[0].message.parsed
-    try:
-        return data.execute_sql_query(parsed_json.sql_query)
-    except Exception as e:
-        logger.info(f"Trying to recover by generating a fix for the query causing an error")
-        improved_sql = generate_fix(e, parsed_json.sql_query, question)
-        return data.execute_sql_query(improved_sql.choices[0].message.parsed.sql_query, iteration=1)
+def answer_question(question, standalone=False):
+    """Answer a question in the ongoing conversation; standalone=True marks one that doesn't depend on it,
+    which lets RESPONSE_CACHE=1 serve its SQL from earlier runs"""
+    # Opt-in because a follow-up such as "What about by country?" depends on the conversation so far
+    if os.getenv("ANSWER_CACHE") == "1":
+        # Each caller gets its own copy, so mutating an answer can't corrupt the cached DataFrame
+        return _answer_question_cached(question, standalone).copy()
+    return _answer_question(question, standalone)
+
+@functools.lru_cache(maxsize=256)
+def _answer_question_cached(question, standalone):
+    return _answer_question(question, standalone)
+
+def _answer_question(question, standalone=False):
+    # RESPONSE_CACHE=1 reuses the SQL generated for the same (or a near-identical) question in earlier runs.
+    # Only the SQL is cached, so the answer always reflects the current data.
+    cache = get_response_cache() if standalone and os.getenv("RESPONSE_CACHE") == "1" else None
+    cached_sql = cache.get(question) if cache else None
+    if cached_sql is not None:
+        # Recorded as if it had been generated, so follow-up questions still see this turn
+        llm_client.add_chat_history([{"role": "user", "content": question}])
+        llm_client.add_chat_history({"role": "assistant", "content": SQLGeneration(steps=[], sql_query=cached_sql).model_dump_json()})
+        sql_query = cached_sql
+    else:
+        sql_query = extract_sql(completion(build_prompt(question)))
+    result, sql_query = execute_with_fixes(sql_query, question)
+    # Cached only once it has run, so a repaired query replaces the draft that needed fixing
+    if cache and sql_query != cached_sql:
+        cache.set(question, sql_query)
+    return result
+
+@functools.lru_cache(maxsize=1)
+def get_response_cache():
+    return ResponseCache(
+        CACHE_DIR / "responses.sqlite",
+        namespace=cache_key(llm_client.MODEL, list(get_prompt_prefix()), SQLGeneration),
+        embed=llm_client.embed if llm_client.EMBEDDING_MODEL else None
+    )
+
+def batch_answer_questions(questions, batch_size=8):
+    """Generate the SQL for independent questions with one LLM call per batch_size questions, then run each query"""
+    sql_queries = []
+    for start in range(0, len(questions), batch_size):
+        sql_queries += generate_sql_batch(questions[start:start + batch_size])
+    return [run_query(sql_query, question) for sql_query, question in zip(sql_queries, questions)]
+
+def generate_sql_batch(questions):
+    response = llm_client.chat_completion(
+        messages=build_batch_prompt(questions),
+        response_format=SQLGenerationBatch,
+        include_history=False,
+        parsed=True
+    )
+    answers = response.choices[0].message.parsed.answers
+    if len(answers) != len(questions):
+        logger.error("Expected %d SQL queries, got %d", len(questions), len(answers))
+        raise ValueError("Number of generated SQL queries does not match the number of questions")
+    return [answer.sql_query for answer in answers]
+
+def answer_questions(questions):
+    """Answer questions in order, running each query in a thread pool while the next LLM call is in flight"""
+    with ThreadPoolExecutor(max_workers=SQL_WORKERS) as pool:
+        futures = []
+        for question in questions:
+            # Only this thread touches the chat history: fixes on the pool threads run without it
+            response = completion(build_prompt(question))
+            futures.append(pool.submit(run_query, extract_sql(response), question))
+        return [future.result() for future in futures]
+
+async def answer_many(questions, max_concurrency=8):
+    """Answer independent questions concurrently, each running its SQL in a thread pool as soon as it is generated.
+    A question that fails gets its exception in place of an answer instead of failing the whole batch."""
+    semaphore = asyncio.Semaphore(max_concurrency) # Stay under the deployment's rate limit
+    with ThreadPoolExecutor(max_workers=SQL_WORKERS) as pool:
+        async def answer(question):
+            async with semaphore:
+                response = await completion_async(build_prompt(question))
+            return await run_query_async(extract_sql(response), question, pool, semaphore)
+
+        return await asyncio.gather(*(answer(question) for question in questions), return_exceptions=True)
+
+def answer_batch(questions):
+    """Answer independent questions through the Batch API: cheaper, but results can take up to 24h.
+    A failed request gives None, and a query that fails even after fixes gives its exception, in place of an answer."""
+    batch_id = llm_client.submit_batch([build_prompt(question) for question in questions], SQL_SCHEMA)
+    answers = []
+    for response, question in zip(llm_client.poll_batch(batch_id), questions):
+        if response is None:
+            answers.append(None)
+            continue
+        try:
+            answers.append(run_query(extract_sql(response), question))
+        except Exception as e:
+            # One bad query must not throw away the rest of a batch that may have taken hours
+            logger.error("Question %r failed: %s", question, e)
+            answers.append(e)
+    return answers
+
+def extract_sql(response):
+    message = response.choices[0].message
+    # Fixes come back parsed; questions and batch results are plain completions with JSON content
+    parsed = getattr(message, 'parsed', None)
+    if parsed is not None:
+        return parsed.sql_query
+    generation = json.loads(message.content)
+    for step in generation.get("steps", []):
+        logger.info("REASONING - Step: %s", step)
+    return generation["sql_query"]
+
+def run_query(sql_query, question):
+    result, _ = execute_with_fixes(sql_query, question)
+    return result
+
+def execute_with_fixes(sql_query, question):
+    """Run the SQL, asking the LLM to repair it on failure; returns the result and the SQL that produced it"""
+    for attempt in range(MAX_QUERY_ATTEMPTS):
+        try:
+            return data.execute_sql_query(sql_query, iteration=attempt), sql_query
+        except ValueError:
+            raise # Rejected before running (e.g. a banned verb): a fix-up round-trip can't help
+        except Exception as e:
+            if attempt == MAX_QUERY_ATTEMPTS - 1:
+                raise e
+            logger.info("Trying to recover by generating a fix for the query causing an error (attempt %d)", attempt + 1)
+            sql_query = extract_sql(generate_fix(e, sql_query, question))
+
+async def run_query_async(sql_query, question, pool, semaphore):
+    # Same recovery loop as run_query, but a fix-up round-trip awaits instead of holding a pool thread
+    loop = asyncio.get_running_loop()
+    for attempt in range(MAX_QUERY_ATTEMPTS):
+        try:
+            return await loop.run_in_executor(pool, functools.partial(data.execute_sql_query, sql_query, iteration=attempt))
+        except ValueError:
+            raise
+        except Exception as e:
+            if attempt == MAX_QUERY_ATTEMPTS - 1:
+                raise e
+            logger.info("Trying to recover by generating a fix for the query causing an error (attempt %d)", attempt + 1)
+            async with semaphore:
+                sql_query = extract_sql(await generate_fix_async(e, sql_query, question))
     
-def evaluate_sql(generated_sql, correct_sql, query_description):
-    """Evaluate the generated SQL against the correct SQL using an LLM"""
-    eval_prompt = f"""
+EVAL_PROMPT_TEMPLATE = """
     As a SQL expert, evaluate the generated SQL query against the correct SQL query.
     
     Query task: {query_description}
@@ -96,23 +273,40 @@ def evaluate_sql(generated_sql, correct_sql, query_description):
     - "correction": string with corrected SQL if needed (empty string if correct)
     - "explanation": string explaining what was wrong and how it was fixed
     """
-    
+
+def evaluate_sql(generated_sql, correct_sql, query_description):
+    """Evaluate the generated SQL against the correct SQL using an LLM"""
+    # The cache holds the raw JSON so every caller gets its own dict
+    return json.loads(_evaluate_sql_cached(generated_sql, correct_sql, query_description))
+
+@functools.lru_cache(maxsize=512)
+def _evaluate_sql_cached(generated_sql, correct_sql, query_description):
+    eval_prompt = EVAL_PROMPT_TEMPLATE.format_map({
+        "query_description": query_description,
+        "generated_sql": generated_sql,
+        "correct_sql": correct_sql
+    })
     response = llm_client.chat_completion(
         messages=[{"role": "system", "content": "You are a SQL expert evaluator."},
                  {"role": "user", "content": eval_prompt}],
-        response_format={"type": "json_object"}
+        response_format={"type": "json_object"},
+        include_history=False # A cached verdict must not depend on the conversation it was first asked in
     )
-    
-    result = json.loads(response.choices[0].message.content)
-    return result
+    return response.choices[0].message.content
 
 if __name__ == "__main__":
-    setup()
+    setup_logging()
+    if "--batch" in sys.argv:
+        # python main.py --batch "First question" "Second question" ...
+        for answer in answer_batch([arg for arg in sys.argv[1:] if arg != "--batch"]):
+            print(answer)
+        sys.exit()
     query_description = 'What is the correlation between review score and customer city?'
-    answer = answer_question(query_description)
+    answer = answer_question(query_description, standalone=True)
     answer2 = answer_question('What about by country?')
     print(answer)
     print(answer2)
+    logger.info("Session token usage: %s", llm_client.usage_totals())
     # generated = 'SELECT ROUND((AVG(r.review_score * ov.order_value) - AVG(r.review_score) * AVG(ov.order_value)) / (STDEV(r.review_score) * STDEV(ov.order_value)), 2) AS correlation\nFROM (\n    SELECT order_id, SUM(price + freight_value) AS order_value\n    FROM order_items\n    GROUP BY order_id\n) ov\nJOIN order_reviews r ON ov.order_id = r.order_id;'
     # correct = 'WITH order_values AS (\n    SELECT order_id, SUM(price + freight_value) AS order_value\n    FROM order_items\n    GROUP BY order_id\n)\nSELECT r.review_score,\n       ROUND(AVG(ov.order_value), 2) AS avg_order_value\nFROM order_reviews r\nJOIN order_values ov ON r.order_id = ov.order_id\nGROUP BY r.review_score\nORDER BY r.review_score;'
     # print(data.execute_sql_query(correct))
@@ -0,0 +1,63 @@
+import functools
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+import numpy as np
+
+class ResponseCache:
+    """Generated SQL per question: exact matches by hash, paraphrases by embedding similarity (when embed is given)"""
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, path, namespace, embed=None, threshold=0.95):
+        self.path = path
+        self.namespace = namespace # Changes whenever the model, prompt or schema change, invalidating old entries
+        self.embed = functools.lru_cache(maxsize=256)(embed) if embed else None # get() then set() embeds once
+        self.threshold = threshold
+        self._conn = None
+
+    def connect(self):
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, namespace TEXT, question TEXT, sql_query TEXT, embedding TEXT, created REAL)"
+            )
+        return self._conn
+
+    def key(self, question):
+        return hashlib.sha256(f"{self.namespace}\n{question}".encode()).hexdigest()
+
+    def get(self, question):
+        conn = self.connect()
+        row = conn.execute("SELECT sql_query FROM responses WHERE key = ?", (self.key(question),)).fetchone()
+        if row is not None:
+            self.logger.info("Exact cache hit for question: %s", question)
+            return row[0]
+        if self.embed is None:
+            return None
+
+        rows = conn.execute(
+            "SELECT question, sql_query, embedding FROM responses WHERE namespace = ? AND embedding IS NOT NULL",
+            (self.namespace,)
+        ).fetchall()
+        if not rows:
+            return None
+        vectors = np.array([json.loads(embedding) for _, _, embedding in rows])
+        query = np.array(self.embed(question))
+        similarities = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        self.logger.info("Semantic cache hit (%.3f) for question: %s ~ %s", similarities[best], question, rows[best][0])
+        return rows[best][1]
+
+    def set(self, question, sql_query):
+        embedding = json.dumps(list(self.embed(question))) if self.embed else None
+        self.connect().execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (self.key(question), self.namespace, question, sql_query, embedding, time.time())
+        )
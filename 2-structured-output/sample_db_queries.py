@@ -19,4 +19,7 @@ examples = [
         {"role": "user", "content": 'What is the correlation between review score and order value?'},
         {"role": "assistant", "content": 'WITH MeanValues AS (\n    SELECT \n        AVG(r.review_score) AS avg_review_score,\n        AVG(ov.order_value) AS avg_order_value\n    FROM order_reviews r\n    JOIN (\n        SELECT order_id, SUM(price + freight_value) AS order_value\n        FROM order_items\n        GROUP BY order_id\n    ) ov ON r.order_id = ov.order_id\n),\nCovariance AS (\n    SELECT \n        SUM((r.review_score - mv.avg_review_score) * (ov.order_value - mv.avg_order_value)) / COUNT(*) AS covariance\n    FROM order_reviews r\n    JOIN (\n        SELECT order_id, SUM(price + freight_value) AS order_value\n        FROM order_items\n        GROUP BY order_id\n    ) ov ON r.order_id = ov.order_id,\n    MeanValues mv\n),\nStandardDevs AS (\n    SELECT \n        SQRT(SUM((r.review_score - mv.avg_review_score) * (r.review_score - mv.avg_review_score)) / COUNT(*)) AS stddev_review_score,\n        SQRT(SUM((ov.order_value - mv.avg_order_value) * (ov.order_value - mv.avg_order_value)) / COUNT(*)) AS stddev_order_value\n    FROM order_reviews r\n    JOIN (\n        SELECT order_id, SUM(price + freight_value) AS order_value\n        FROM order_items\n        GROUP BY order_id\n    ) ov ON r.order_id = ov.order_id,\n    MeanValues mv\n)\nSELECT ROUND(cov.covariance / (std.stddev_review_score * std.stddev_order_value), 2) AS correlation_value\nFROM Covariance cov, StandardDevs std;'}
     ]
-]
\ No newline at end of file
+]
+
+# Flattened once at import so prompts can extend with the messages directly
+flat_examples = [message for example in examples for message in example]
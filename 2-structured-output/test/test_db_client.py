@@ -0,0 +1,97 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import db_client
+from db_client import Olist, format_result_for_llm
+
+data = Olist()
+
+def test_safety_check_rejects_banned_verbs():
+    with pytest.raises(ValueError, match="DROP"):
+        data.safety_check("drop table orders")
+
+def test_safety_check_allows_read_only_queries():
+    data.safety_check("SELECT order_id, order_delivered_customer_date AS update_date, REPLACE(customer_city, '-', ' ') FROM orders")
+
+def test_execute_sql_query_rejects_banned_verbs():
+    with pytest.raises(ValueError, match="DELETE"):
+        data.execute_sql_query("DELETE FROM orders")
+
+def test_format_result_for_llm():
+    result = format_result_for_llm(['seller_id', 'order_count'], [('4a3ca9315b744ce9f8e9374361493884', 1278)])
+    assert result == "| seller_id | order_count |\n| --- | --- |\n| 4a3ca9315b744ce9f8e9374361493884 | 1278 |"
+
+def test_format_result_for_llm_truncates_rows():
+    rows = [(i,) for i in range(60)]
+    result = format_result_for_llm(['order_id'], rows, max_rows=50)
+    assert "| 49 |" in result
+    assert "| 50 |" not in result
+    assert result.endswith("... 10 more rows")
+
+def test_format_result_for_llm_escapes_pipes():
+    result = format_result_for_llm(['category'], [('cama|mesa',)])
+    assert "| cama\\|mesa |" in result
+
+def test_multi_statement_error_keeps_connection():
+    olist = Olist()
+    conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+    olist._conn = conn
+    with pytest.raises(sqlite3.ProgrammingError, match="one statement"):
+        olist.execute_sql_query("SELECT 1; SELECT 2")
+    assert olist._conn is conn
+    assert olist.execute_sql_query("SELECT 1 AS one").iat[0, 0] == 1
+
+def test_closed_connection_is_reopened(tmp_path, monkeypatch):
+    sqlite3.connect(tmp_path / 'olist.sqlite').close()
+    monkeypatch.setattr(Olist, 'db_path', str(tmp_path / 'olist.sqlite'))
+    monkeypatch.setattr(db_client, 'cx', None) # Exercise the shared sqlite3 connection
+    olist = Olist()
+    olist.connect_data().close()
+    assert olist.execute_sql_query("SELECT 1 AS one").iat[0, 0] == 1
+
+def test_execute_sql_query_returns_dataframe():
+    olist = Olist()
+    olist._conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+    result = olist.execute_sql_query("SELECT 1 AS one")
+    assert isinstance(result, pd.DataFrame)
+    assert result.to_dict('list') == {'one': [1]}
+
+def test_connectorx_reads_frames_unless_in_memory(monkeypatch):
+    reads = []
+    def read_sql(connection, query, return_type):
+        reads.append((connection, query))
+        return pd.DataFrame({'one': [1]})
+    monkeypatch.setattr(db_client, 'cx', SimpleNamespace(read_sql=read_sql))
+    olist = Olist()
+    olist._conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+
+    assert olist.execute_sql_query("SELECT 1 AS one").to_dict('list') == {'one': [1]}
+    assert reads == [(f"sqlite://{Olist.db_path}", "SELECT 1 AS one")]
+
+    monkeypatch.setenv("OLIST_INMEM", "1")
+    assert olist.execute_sql_query("SELECT 1 AS one").to_dict('list') == {'one': [1]}
+    assert len(reads) == 1
+
+def test_connectorx_failure_falls_back_to_sqlite(monkeypatch):
+    def read_sql(connection, query, return_type):
+        raise RuntimeError("unable to open database file")
+    monkeypatch.setattr(db_client, 'cx', SimpleNamespace(read_sql=read_sql))
+    olist = Olist()
+    olist._conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+    assert olist.execute_sql_query("SELECT 1 AS one").to_dict('list') == {'one': [1]}
+
+@pytest.mark.parametrize("in_memory", ["0", "1"])
+def test_connection_is_read_only(tmp_path, monkeypatch, in_memory):
+    with sqlite3.connect(tmp_path / 'olist.sqlite') as conn:
+        conn.execute("CREATE TABLE sellers (seller_id TEXT PRIMARY KEY)")
+    monkeypatch.setattr(Olist, 'db_path', str(tmp_path / 'olist.sqlite'))
+    monkeypatch.setattr(db_client, 'cx', None)
+    monkeypatch.setenv("OLIST_INMEM", in_memory)
+    olist = Olist()
+    # REPLACE INTO gets past the keyword check, so the connection itself has to refuse it
+    with pytest.raises(sqlite3.OperationalError, match="readonly|read-only"):
+        olist.execute_sql_query("REPLACE INTO sellers VALUES ('4a3ca9315b744ce9f8e9374361493884')")
+
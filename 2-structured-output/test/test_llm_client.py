@@ -1,7 +1,18 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import httpx
+from openai import RateLimitError
+from openai.types import CompletionUsage
+from openai.types.chat import ParsedChatCompletion
+from openai.types.completion_usage import PromptTokensDetails
 from pydantic import BaseModel, Field
 import pytest
 
-from llm_client import LLMClient
+import llm_client
+from llm_client import LLMClient, _AZURE_CLIENT, cache_key, disk_cached
 
 class MockSQLGeneration(BaseModel):
     steps: list[str] = Field(..., description="Short chain-of-thought steps explaining the logic")
@@ -75,4 +86,175 @@ def test_recall_chat_history_not_contains_system_messages():
     recall = client.recall_chat_history()
 
     for message in recall:
-        assert message['role'] != 'system'
\ No newline at end of file
+        assert message['role'] != 'system'
+
+
+def test_recall_chat_history_is_bounded():
+    client.chat_history = []
+    for i in range(client.MAX_HISTORY_MESSAGES + 5):
+        client.add_chat_history([{'role': 'user', 'content': f'Question {i}'}])
+
+    recall = client.recall_chat_history()
+    assert len(recall) == client.MAX_HISTORY_MESSAGES
+    assert recall[-1] == {'role': 'user', 'content': f'Question {client.MAX_HISTORY_MESSAGES + 4}'}
+
+def test_recall_chat_history_starts_with_a_question():
+    client.chat_history = []
+    for i in range(client.MAX_HISTORY_MESSAGES // 2):
+        client.add_chat_history([{'role': 'user', 'content': f'Question {i}'}])
+        client.add_chat_history({'role': 'assistant', 'content': f'Answer {i}'})
+    client.add_chat_history([{'role': 'user', 'content': 'Follow-up question'}])
+
+    recall = client.recall_chat_history()
+    assert len(recall) == client.MAX_HISTORY_MESSAGES - 1
+    assert recall[0] == {'role': 'user', 'content': 'Question 1'}
+    assert recall[-1] == {'role': 'user', 'content': 'Follow-up question'}
+
+def test_reset_history():
+    client.add_chat_history([{'role': 'user', 'content': 'Which orders have been delivered?'}])
+    client.reset_history()
+
+    assert client.recall_chat_history() == []
+    assert len(client.chat_history) == 0
+
+def test_cache_key_is_stable_and_schema_sensitive():
+    messages = [{'role': 'user', 'content': 'Which orders have been delivered?'}]
+    reordered = [{'content': 'Which orders have been delivered?', 'role': 'user'}]
+
+    assert cache_key('gpt-4o', messages, MockSQLGeneration) == cache_key('gpt-4o', reordered, MockSQLGeneration)
+    assert cache_key('gpt-4o', messages, MockSQLGeneration) != cache_key('gpt-4o', messages, mock_response_format)
+    assert cache_key('gpt-4o', messages, MockSQLGeneration) != cache_key('o3-mini', messages, MockSQLGeneration)
+
+def test_usage_totals_accumulate():
+    fresh = LLMClient()
+    fresh._add_usage(CompletionUsage(prompt_tokens=100, completion_tokens=20, total_tokens=120))
+    cached_tokens = fresh._add_usage(CompletionUsage(
+        prompt_tokens=50, completion_tokens=5, total_tokens=55,
+        prompt_tokens_details=PromptTokensDetails(cached_tokens=32)
+    ))
+
+    assert cached_tokens == 32
+    assert fresh.usage_totals() == {
+        'requests': 2, 'prompt_tokens': 150, 'completion_tokens': 25, 'total_tokens': 175, 'cached_tokens': 32
+    }
+
+def test_async_client_is_per_event_loop():
+    async def clients():
+        return client.aclient, client.aclient
+
+    first, same_loop = asyncio.run(clients())
+    second, _ = asyncio.run(clients())
+    assert first is same_loop
+    assert first is not second
+
+def test_rate_limit_is_retried_by_tenacity_only(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    attempts = []
+    def create(**kwargs):
+        attempts.append(kwargs)
+        response = httpx.Response(429, request=httpx.Request("POST", "https://example.invalid/chat/completions"))
+        raise RateLimitError("Rate limit reached", response=response, body=None)
+
+    fresh = LLMClient()
+    fresh.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    with pytest.raises(RateLimitError):
+        fresh.chat_completion([{'role': 'user', 'content': 'Which orders have been delivered?'}], mock_response_format, include_history=False)
+    assert len(attempts) == 5
+    # The SDK must not multiply those attempts with its own retries
+    assert _AZURE_CLIENT.max_retries == 0
+    assert asyncio.run(_async_client_retries(fresh)) == 0
+
+async def _async_client_retries(llm_client):
+    return llm_client.aclient.max_retries
+
+SQL_COMPLETION = {
+    "id": "chatcmpl-1", "object": "chat.completion", "created": 1735689600, "model": "gpt-4o",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {
+        "role": "assistant",
+        "content": '{"steps": ["Filter delivered orders"], "sql_query": "SELECT * FROM orders WHERE order_status = \'delivered\'"}',
+        "parsed": {"steps": ["Filter delivered orders"], "sql_query": "SELECT * FROM orders WHERE order_status = 'delivered'"}
+    }}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+}
+
+class CachedRequests:
+    MODEL = "gpt-4o"
+    logger = LLMClient.logger
+
+    def __init__(self):
+        self.calls = 0
+
+    @disk_cached
+    def complete(self, messages, response_format, parsed):
+        self.calls += 1
+        return ParsedChatCompletion[response_format].model_validate(SQL_COMPLETION)
+
+    @disk_cached
+    async def acomplete(self, messages, response_format, parsed):
+        self.calls += 1
+        return ParsedChatCompletion[response_format].model_validate(SQL_COMPLETION)
+
+@pytest.fixture
+def llm_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_client, "CACHE_DIR", tmp_path)
+    monkeypatch.setenv("LLM_CACHE", "1")
+    return tmp_path
+
+def test_disk_cache_replays_parsed_completion(llm_cache):
+    requests = CachedRequests()
+    messages = [{"role": "user", "content": "Which orders have been delivered?"}]
+    first = requests.complete(messages, MockSQLGeneration, True)
+    replay = requests.complete(messages, MockSQLGeneration, True)
+
+    assert requests.calls == 1
+    [stored] = llm_cache.glob("*.json")
+    assert '"parsed"' not in stored.read_text() # Stored as the API returned it
+    assert replay.choices[0].message.parsed == first.choices[0].message.parsed
+    assert isinstance(replay.choices[0].message.parsed, MockSQLGeneration)
+
+def test_disk_cache_replays_parsed_completion_async(llm_cache):
+    requests = CachedRequests()
+    messages = [{"role": "user", "content": "Which orders have been delivered?"}]
+    first = asyncio.run(requests.acomplete(messages, MockSQLGeneration, True))
+    replay = asyncio.run(requests.acomplete(messages, MockSQLGeneration, True))
+
+    assert requests.calls == 1
+    assert replay.choices[0].message.parsed == first.choices[0].message.parsed
+    assert isinstance(replay.choices[0].message.parsed, MockSQLGeneration)
+
+def test_submit_batch_uploads_one_request_per_conversation():
+    uploads = []
+    fresh = LLMClient()
+    fresh.client = SimpleNamespace(
+        files=SimpleNamespace(create=lambda file, purpose: uploads.append(file) or SimpleNamespace(id="file-1")),
+        batches=SimpleNamespace(create=lambda **kwargs: SimpleNamespace(id="batch-1", **kwargs))
+    )
+    conversations = [[{"role": "user", "content": "Which orders have been delivered?"}],
+                     [{"role": "user", "content": "How many orders were made in each month?"}]]
+
+    assert fresh.submit_batch(conversations, MockSQLGeneration) == "batch-1"
+    [(filename, content)] = uploads
+    lines = [json.loads(line) for line in content.decode().splitlines()]
+    assert [line["custom_id"] for line in lines] == ["req-0", "req-1"]
+    assert [line["body"]["messages"] for line in lines] == conversations
+    assert lines[0]["body"]["response_format"] == llm_client.response_format_param(MockSQLGeneration)
+
+def test_poll_batch_returns_completions_in_submission_order():
+    statuses = iter(["in_progress", "completed"])
+    output = "\n".join([
+        json.dumps({"custom_id": "req-1", "response": {"status_code": 200, "body": SQL_COMPLETION}}),
+        json.dumps({"custom_id": "req-0", "response": {"status_code": 429, "body": {}}}),
+        ""
+    ])
+    fresh = LLMClient()
+    fresh.client = SimpleNamespace(
+        batches=SimpleNamespace(retrieve=lambda batch_id: SimpleNamespace(
+            status=next(statuses), request_counts=SimpleNamespace(total=2), output_file_id="file-2", errors=None
+        )),
+        files=SimpleNamespace(content=lambda file_id: SimpleNamespace(text=output))
+    )
+
+    completions = fresh.poll_batch("batch-1", interval=0)
+    assert completions[0] is None
+    assert "SELECT" in completions[1].choices[0].message.content
+
@@ -1,23 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+
 import pytest
 
 import main
+from response_cache import ResponseCache
+
+# The same two questions go through every entry point that answers a list of questions
+TWO_QUESTIONS = ["Which seller has delivered the most orders to customers in Rio de Janeiro? [string: seller_id]",
+                 "What's the average review score for products in the 'beleza_saude' category? [float: score]"]
+
+def assert_two_questions_answered(result):
+    assert len(result) == 2
+    assert "4a3ca9315b744ce9f8e9374361493884" in str(result[0])
+    assert "4.14" in str(result[1])
 
 @pytest.fixture(autouse=True)
-def before_and_after_each():
-    main.setup()
-    yield
+def fresh_history():
+    # Every test is an independent question: without this, each recorded prompt depends on the tests run before it
+    main.llm_client.reset_history()
+
+def test_data_singleton():
+    assert main.data is not None
+    assert isinstance(main.data, main.Olist)
 
 def test_build_prompt():
     question = "Which seller has delivered the most orders to customers in Rio de Janeiro? [string: seller_id]"
     result = main.build_prompt(question)
     assert "Which seller has delivered the most orders to customers in Rio de Janeiro?" in result[0]["content"]
 
+def test_build_prompt_shares_prefix():
+    first = main.build_prompt("Which orders have been delivered?")
+    second = main.build_prompt("How many orders were made in each month?")
+    assert first[:-1] == second[:-1]
+    assert second[-1] == {"role": "user", "content": "How many orders were made in each month?"}
+
 @pytest.mark.vcr()
 def test_completion():
     messages = [{"role": "system", "content": "You are an expert in Olist's DB. Provide 1-3 short reasoning steps, then a final SQL."},
     {"role": "user", "content": "Which seller has delivered the most orders to customers in Rio de Janeiro?"}]
     result = main.completion(messages)
-    assert "SELECT" in result.choices[0].message.parsed.sql_query
+    assert "SELECT" in main.extract_sql(result)
 
 @pytest.mark.vcr()
 def test_generate_fix():
@@ -27,6 +50,20 @@ def test_generate_fix():
     result = main.generate_fix(error, last_query, original_prompt)
     assert "SELECT * FROM orders" in result.choices[0].message.parsed.sql_query
 
+@pytest.mark.vcr()
+def test_generate_fix_async():
+    last_query = "SELECT * FROM orderers WHERE order_status = 'delivered'"
+    error = f"pandas.errors.DatabaseError: Execution failed on sql '{last_query}': no such table: orderers"
+    original_prompt = "Which orders have been delivered?"
+    result = asyncio.run(main.generate_fix_async(error, last_query, original_prompt))
+    assert "SELECT * FROM orders" in result.choices[0].message.parsed.sql_query
+
+def test_extract_sql_from_json_content():
+    response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+        content='{"steps": ["Filter delivered orders"], "sql_query": "SELECT * FROM orders WHERE order_status = \'delivered\'"}'
+    ))])
+    assert main.extract_sql(response) == "SELECT * FROM orders WHERE order_status = 'delivered'"
+
 def test_get_context():
     result = main.get_context()
     assert "dataset from Olist Store" in result
@@ -37,6 +74,70 @@ def test_evaluate_answer_question():
     result = main.answer_question(question)
     assert "4a3ca9315b744ce9f8e9374361493884" in str(result)
 
+def test_followup_after_cache_hit_is_not_served_from_cache(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "responses.sqlite", namespace="test")
+    cache.set("What is the correlation between review score and customer city?", "SELECT 1")
+    cache.set("What about by country?", "SELECT 2")
+    prompts = []
+    def completion(messages):
+        prompts.append(messages)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(parsed=SimpleNamespace(sql_query="SELECT 3")))])
+    monkeypatch.setenv("RESPONSE_CACHE", "1")
+    monkeypatch.setattr(main, "get_response_cache", lambda: cache)
+    monkeypatch.setattr(main, "completion", completion)
+    monkeypatch.setattr(main, "execute_with_fixes", lambda sql_query, question: (sql_query, sql_query))
+
+    assert main.answer_question("What is the correlation between review score and customer city?", standalone=True) == "SELECT 1"
+    assert prompts == []
+    assert main.llm_client.recall_chat_history()[0] == {"role": "user", "content": "What is the correlation between review score and customer city?"}
+
+    assert main.answer_question("What about by country?") == "SELECT 3"
+    assert len(prompts) == 1
+
+def test_answer_batch_keeps_other_answers_when_one_fails(monkeypatch):
+    def run_query(sql_query, question):
+        if sql_query == "SELECT * FROM orderers":
+            raise RuntimeError("no such table: orderers")
+        return sql_query
+    response = lambda sql_query: SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+        content=f'{{"steps": [], "sql_query": "{sql_query}"}}'
+    ))])
+    monkeypatch.setattr(main.llm_client, "submit_batch", lambda messages_list, response_format: "batch-1")
+    monkeypatch.setattr(main.llm_client, "poll_batch", lambda batch_id: [
+        response("SELECT * FROM orderers"), None, response("SELECT COUNT(*) FROM sellers")
+    ])
+    monkeypatch.setattr(main, "run_query", run_query)
+
+    answers = main.answer_batch(["Which orders have been delivered?", "How many customers are there?", "How many sellers are there?"])
+    assert isinstance(answers[0], RuntimeError)
+    assert answers[1] is None
+    assert answers[2] == "SELECT COUNT(*) FROM sellers"
+
+def test_banned_query_is_not_sent_for_fixes(monkeypatch):
+    fixes = []
+    monkeypatch.setattr(main, "generate_fix", lambda *args: fixes.append(args))
+    with pytest.raises(ValueError, match="DELETE"):
+        main.execute_with_fixes("DELETE FROM orders", "Delete all orders")
+    assert fixes == []
+
+@pytest.mark.vcr()
+def test_answer_questions():
+    assert_two_questions_answered(main.answer_questions(TWO_QUESTIONS))
+
+def test_build_batch_prompt():
+    questions = ["Which orders have been delivered?", "How many orders were made in each month?"]
+    result = main.build_batch_prompt(questions)
+    assert result[:-1] == main.build_prompt(questions[0])[:-1]
+    assert "1. Which orders have been delivered?\n2. How many orders were made in each month?" in result[-1]["content"]
+
+@pytest.mark.vcr()
+def test_batch_answer_questions():
+    assert_two_questions_answered(main.batch_answer_questions(TWO_QUESTIONS))
+
+@pytest.mark.vcr()
+def test_answer_many():
+    assert_two_questions_answered(asyncio.run(main.answer_many(TWO_QUESTIONS)))
+
 @pytest.mark.vcr()
 def test_evaluate_sql_simple():
     generated_sql = "SELECT * FROM orders"
@@ -0,0 +1,23 @@
+from response_cache import ResponseCache
+
+EMBEDDINGS = {
+    "Which orders have been delivered?": [1.0, 0.0, 0.0],
+    "Which orders were delivered?": [0.99, 0.05, 0.0],
+    "How many orders were made in each month?": [0.0, 1.0, 0.0],
+}
+
+def test_exact_hit(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.sqlite", namespace="gpt-4o")
+    cache.set("Which orders have been delivered?", "SELECT * FROM orders WHERE order_status = 'delivered'")
+    assert cache.get("Which orders have been delivered?") == "SELECT * FROM orders WHERE order_status = 'delivered'"
+    assert cache.get("Which orders were delivered?") is None
+
+def test_namespace_isolates_entries(tmp_path):
+    ResponseCache(tmp_path / "responses.sqlite", namespace="gpt-4o").set("Which orders have been delivered?", "SELECT 1")
+    assert ResponseCache(tmp_path / "responses.sqlite", namespace="o3-mini").get("Which orders have been delivered?") is None
+
+def test_semantic_hit(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.sqlite", namespace="gpt-4o", embed=EMBEDDINGS.__getitem__)
+    cache.set("Which orders have been delivered?", "SELECT * FROM orders WHERE order_status = 'delivered'")
+    assert cache.get("Which orders were delivered?") == "SELECT * FROM orders WHERE order_status = 'delivered'"
+    assert cache.get("How many orders were made in each month?") is None
@@ -1,52 +1,68 @@
+import asyncio
+import pytest
+
 import main
 # The LLM should be able to generate SQL queries to answer the following questions correctly:
+QUESTIONS = [
+    "Which seller has delivered the most orders to customers in Rio de Janeiro? [string: seller_id]",
+    "What's the average review score for products in the 'beleza_saude' category? [float: score]",
+    "How many sellers have completed orders worth more than 100,000 BRL in total? [integer: count]",
+    "Which product category has the highest rate of 5-star reviews? [string: category_name]",
+    "What's the most common payment installment count for orders over 1000 BRL? [integer: installments]",
+    "Which city has the highest average freight value per order? [string: city_name]",
+    "What's the most expensive product category based on average price? [string: category_name]",
+    "Which product category has the shortest average delivery time? [string: category_name]",
+    "How many orders have items from multiple sellers? [integer: count]",
+    "What percentage of orders are delivered before the estimated delivery date? [float: percentage]",
+]
+
+@pytest.fixture(scope="module")
+def answers():
+    # The questions are independent, so answer them all concurrently instead of one round-trip per test
+    return dict(zip(QUESTIONS, asyncio.run(main.answer_many(QUESTIONS))))
+
+def answer_for(answers, question):
+    answer = answers[question]
+    if isinstance(answer, Exception):
+        raise answer
+    return answer
 
-def test_1():
-    question = "Which seller has delivered the most orders to customers in Rio de Janeiro? [string: seller_id]"
-    answer = main.answer_question(question)
+def test_1(answers):
+    answer = answer_for(answers, QUESTIONS[0])
     assert "4a3ca9315b744ce9f8e9374361493884" in str(answer)
 
-def test_2():
-    question = "What's the average review score for products in the 'beleza_saude' category? [float: score]"
-    answer = main.answer_question(question)
+def test_2(answers):
+    answer = answer_for(answers, QUESTIONS[1])
     assert "4.14" in str(answer)
 
-def test_3():
-    question = "How many sellers have completed orders worth more than 100,000 BRL in total? [integer: count]"
-    answer = main.answer_question(question)
+def test_3(answers):
+    answer = answer_for(answers, QUESTIONS[2])
     assert "0" in str(answer)
 
-def test_4():
-    question = "Which product category has the highest rate of 5-star reviews? [string: category_name]"
-    answer = main.answer_question(question)
+def test_4(answers):
+    answer = answer_for(answers, QUESTIONS[3])
     assert "beleza_saude" in str(answer)
 
-def test_5():
-    question = "What's the most common payment installment count for orders over 1000 BRL? [integer: installments]"
-    answer = main.answer_question(question)
+def test_5(answers):
+    answer = answer_for(answers, QUESTIONS[4])
     assert "1" in str(answer)
 
-def test_6():
-    question = "Which city has the highest average freight value per order? [string: city_name]"
-    answer = main.answer_question(question)
+def test_6(answers):
+    answer = answer_for(answers, QUESTIONS[5])
     assert "itupiranga" in str.lower(str(answer))
 
-def test_7():
-    question = "What's the most expensive product category based on average price? [string: category_name]"
-    answer = main.answer_question(question)
+def test_7(answers):
+    answer = answer_for(answers, QUESTIONS[6])
     assert "pcs" in str(answer)
 
-def test_8():
-    question = "Which product category has the shortest average delivery time? [string: category_name]"
-    answer = main.answer_question(question)
+def test_8(answers):
+    answer = answer_for(answers, QUESTIONS[7])
     assert "artesanato" in str(answer)    
 
-def test_9():
-    question = "How many orders have items from multiple sellers? [integer: count]"
-    answer = main.answer_question(question)
+def test_9(answers):
+    answer = answer_for(answers, QUESTIONS[8])
     assert 1278 == answer.iat[0, 0] 
 
-def test_10():
-    question = "What percentage of orders are delivered before the estimated delivery date? [float: percentage]"
-    answer = main.answer_question(question)
+def test_10(answers):
+    answer = answer_for(answers, QUESTIONS[9])
     assert 88.0 <= answer.iat[0, 0] <= 92.0